@@ -0,0 +1,85 @@
+"""
+Persisted per-day added counts
+Shared by exporter.py and tools/backfill_openmetrics.py so both write the
+same table with the same rules
+"""
+
+import sqlite3
+from typing import Dict, List, Tuple
+
+
+class AddedCountsStore:
+    """SQLite store of items added per day, per source
+
+    A movie's added date never changes, so Radarr only recounts days from
+    the latest stored date onwards and days of since-deleted movies are
+    kept. Sonarr counts episode files per series added date, which change
+    as episodes are downloaded, so its days are all recounted and replaced.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS added_counts (
+            source TEXT NOT NULL,
+            date TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (source, date)
+        )
+    """
+
+    def __init__(self, path: str):
+        """Open the database and create the table; raises sqlite3.Error on failure"""
+        self.path = path
+        # Opened here but only used from the collection thread afterwards
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(self.SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def last_date(self, source: str) -> str:
+        """Return the latest stored date for a source, or "" if there is none"""
+        row = self._conn.execute(
+            "SELECT MAX(date) FROM added_counts WHERE source = ?", (source,)
+        ).fetchone()
+        return row[0] or ""
+
+    def update(self, source: str, date_counts: Dict[str, int]):
+        """Insert or replace the counts for the given dates"""
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO added_counts (source, date, count) VALUES (?, ?, ?) "
+                "ON CONFLICT (source, date) DO UPDATE SET count = excluded.count",
+                [(source, date, count) for date, count in date_counts.items()],
+            )
+
+    def update_since_last(self, source: str, date_counts: Dict[str, int]):
+        """Store only the counts from the latest stored date onwards
+
+        For sources whose past days never change, so counts of items that
+        have since been deleted stay in the stored history.
+        """
+        since = self.last_date(source)
+        self.update(source, {date: count for date, count in date_counts.items() if date >= since})
+
+    def replace(self, source: str, date_counts: Dict[str, int]):
+        """Replace all stored counts for a source"""
+        with self._conn:
+            self._conn.execute("DELETE FROM added_counts WHERE source = ?", (source,))
+            self._conn.executemany(
+                "INSERT INTO added_counts (source, date, count) VALUES (?, ?, ?)",
+                [(source, date, count) for date, count in date_counts.items()],
+            )
+
+    def total(self, source: str) -> int:
+        """Return the sum of all stored counts for a source"""
+        row = self._conn.execute(
+            "SELECT COALESCE(SUM(count), 0) FROM added_counts WHERE source = ?", (source,)
+        ).fetchone()
+        return row[0]
+
+    def cumulative(self, source: str) -> List[Tuple[str, int]]:
+        """Return (date, running total) for every stored date of a source"""
+        return self._conn.execute(
+            "SELECT date, SUM(count) OVER (ORDER BY date) FROM added_counts WHERE source = ? ORDER BY date",
+            (source,),
+        ).fetchall()
@@ -6,14 +6,20 @@ Exports metrics from Radarr, Sonarr, and Jellyfin for Prometheus scraping
 
 import os
 import time
+import asyncio
 import logging
+import sqlite3
+import threading
 from datetime import datetime
-from collections import defaultdict
-from typing import Dict, List, Any
+from collections import Counter
+from typing import Callable, Dict, List, Any, Optional, Tuple
 
-import requests
-from prometheus_client import start_http_server, Gauge, Counter, Histogram, Info
-from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
+import aiohttp
+import orjson
+from prometheus_client import start_http_server
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+
+from added_counts import AddedCountsStore
 
 # Configure logging
 logging.basicConfig(
@@ -22,6 +28,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Video codec name normalization
+_CODEC_MAP = {'x265': 'HEVC', 'h265': 'HEVC', 'x264': 'H.264', 'h264': 'H.264'}
+
 
 class Config:
     """Configuration from environment variables"""
@@ -45,120 +54,283 @@ class Config:
     # Exporter settings
     EXPORTER_PORT = int(os.getenv("EXPORTER_PORT", "9877"))
     SCRAPE_INTERVAL = int(os.getenv("SCRAPE_INTERVAL", "60"))
+    
+    # Response cache TTLs in seconds per API endpoint (0 disables caching)
+    CACHE_TTLS = {
+        "movie": int(os.getenv("CACHE_TTL_MOVIE", "300")),
+        "series": int(os.getenv("CACHE_TTL_SERIES", "300")),
+        "episode": int(os.getenv("CACHE_TTL_EPISODE", "300")),
+        "queue": int(os.getenv("CACHE_TTL_QUEUE", "10")),
+        "history": int(os.getenv("CACHE_TTL_HISTORY", "120")),
+        "Sessions": int(os.getenv("CACHE_TTL_SESSIONS", "5")),
+        "user_usage_stats/MoviesReport": int(os.getenv("CACHE_TTL_REPORTS", "300")),
+        "user_usage_stats/GetTvShowsReport": int(os.getenv("CACHE_TTL_REPORTS", "300")),
+    }
+    # Upper bound in seconds on how old a response served after an upstream
+    # outage may be; also capped at a few TTLs of its endpoint
+    CACHE_MAX_STALE = int(os.getenv("CACHE_MAX_STALE", "900"))
+    
+    # SQLite file for persisted per-day added counts (empty disables)
+    STATE_DB = os.getenv("STATE_DB", "")
+
+
+class TTLCache:
+    """Thread-safe cache of API responses keyed on (endpoint, params)
+    
+    Expired entries are kept so the last good response can be served
+    briefly while the upstream service is unavailable.
+    """
+    
+    # Stale responses are served for at most this many TTLs of their endpoint
+    STALE_TTLS = 3
+    
+    def __init__(self, ttls: Dict[str, int] = None, max_stale: int = 900):
+        self.ttls = ttls or {}
+        self.max_stale = max_stale
+        self._entries: Dict[Tuple, Tuple[float, float, Any]] = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _key(endpoint: str, params: Dict = None) -> Tuple:
+        return (endpoint, frozenset((params or {}).items()))
+    
+    def get(self, endpoint: str, params: Dict = None) -> Any:
+        """Return the cached response if it has not expired"""
+        with self._lock:
+            entry = self._entries.get(self._key(endpoint, params))
+        if entry and time.monotonic() < entry[1]:
+            return entry[2]
+        return None
+    
+    def get_stale(self, endpoint: str, params: Dict = None) -> Any:
+        """Return the last cached response if it is not too old to stand in for a fresh one"""
+        with self._lock:
+            entry = self._entries.get(self._key(endpoint, params))
+        if not entry:
+            return None
+        max_age = min(self.max_stale, self.STALE_TTLS * self.ttls.get(endpoint, 0))
+        if time.monotonic() - entry[0] > max_age:
+            return None
+        return entry[2]
+    
+    def set(self, endpoint: str, params: Dict, value: Any):
+        """Store a response using the endpoint's TTL"""
+        now = time.monotonic()
+        with self._lock:
+            self._entries[self._key(endpoint, params)] = (now, now + self.ttls.get(endpoint, 0), value)
+
+
+def _parse_iso(value: Optional[str]) -> Optional[float]:
+    """Parse an ISO 8601 timestamp from the *arr APIs to Unix seconds
+    
+    Returns None for missing or malformed values, so callers skip bad
+    records with a check rather than an exception handler in their loop.
+    """
+    if not value or len(value) < 10:
+        return None
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def _is_unavailable(error: Exception) -> bool:
+    """Whether an error means the service is down, rather than the request being wrong"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+def _new_session() -> aiohttp.ClientSession:
+    """Create the HTTP session shared by all collectors
+    
+    aiohttp pools connections per host, so one session keeps a keepalive
+    pool for each of Radarr, Sonarr and Jellyfin. It also negotiates
+    compression itself, offering br only when Brotli is installed.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, limit_per_host=16, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(total=30),
+    )
+
+
+# Transient upstream errors are retried with exponential backoff
+_RETRY_STATUSES = {502, 503, 504}
+_RETRIES = 2
+_RETRY_BACKOFF = 0.3
+# Overall time budget for a request, shared by all of its attempts
+_REQUEST_TIMEOUT = 30
+
+
+async def _fetch_json(session: aiohttp.ClientSession, method: str, url: str,
+                      timeout: float = _REQUEST_TIMEOUT, raise_for_status: bool = True, **kwargs) -> Any:
+    """Make a request and decode the JSON response, retrying transient failures
+    
+    Gateway errors and connection failures are retried while the overall
+    timeout allows; a timeout is not retried. With raise_for_status=False,
+    a non-200 response returns None instead of raising.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    attempt = 0
+    
+    def can_retry() -> bool:
+        # Only retry if the backoff still leaves time for another attempt
+        return attempt < _RETRIES and deadline - loop.time() > _RETRY_BACKOFF * 2 ** attempt
+    
+    while True:
+        # aiohttp treats a total timeout <= 0 as no timeout at all, so a retry
+        # that starts late (e.g. the loop was busy during backoff) must fail here
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError(f"{method} {url} exceeded its {timeout}s deadline")
+        try:
+            async with session.request(
+                method, url, timeout=aiohttp.ClientTimeout(total=remaining), **kwargs
+            ) as response:
+                if response.status not in _RETRY_STATUSES or not can_retry():
+                    if response.status != 200 and not raise_for_status:
+                        return None
+                    response.raise_for_status()
+                    return orjson.loads(await response.read())
+        except aiohttp.ClientConnectionError as e:
+            if isinstance(e, asyncio.TimeoutError) or not can_retry():
+                raise
+        await asyncio.sleep(_RETRY_BACKOFF * 2 ** attempt)
+        attempt += 1
 
 
 class RadarrCollector:
     """Collects metrics from Radarr"""
     
-    def __init__(self, url: str, api_key: str, tmdb_api_key: str = ""):
+    def __init__(self, url: str, api_key: str, tmdb_api_key: str = "", cache_ttls: Dict[str, int] = None,
+                 cache_max_stale: int = 900, store: Optional[AddedCountsStore] = None):
         self.url = url.rstrip('/')
         self.api_key = api_key
         self.tmdb_api_key = tmdb_api_key
         self.headers = {"X-Api-Key": api_key}
-        self.session = requests.Session()
-        
-    def _get(self, endpoint: str, params: Dict = None) -> Any:
-        """Make GET request to Radarr API"""
+        self.session: Optional[aiohttp.ClientSession] = None  # shared, set by MediaExporter
+        self.cache = TTLCache(cache_ttls, cache_max_stale)
+        self.store = store
+    
+    async def _get(self, endpoint: str, params: Dict = None) -> Any:
+        """Make GET request to Radarr API, serving cached responses where fresh"""
+        cached = self.cache.get(endpoint, params)
+        if cached is not None:
+            return cached
         try:
             url = f"{self.url}/api/v3/{endpoint}"
-            response = self.session.get(url, headers=self.headers, params=params, timeout=30)
-            response.raise_for_status()
-            return response.json()
+            data = await _fetch_json(self.session, "GET", url, headers=self.headers, params=params)
+            self.cache.set(endpoint, params, data)
+            return data
         except Exception as e:
             logger.error(f"Error fetching {endpoint}: {e}")
+            if _is_unavailable(e):
+                # Fall back to a recent good response while the service is down
+                return self.cache.get_stale(endpoint, params)
             return None
     
-    def collect_metrics(self) -> Dict[str, Any]:
+    async def collect_metrics(self) -> Dict[str, Any]:
         """Collect all Radarr metrics"""
         metrics = {}
         
-        # Get all movies
-        movies = self._get("movie")
+        # Fetch movies, queue and history concurrently
+        movies, queue, grab_history, import_history = await asyncio.gather(
+            self._get("movie"),
+            self._get("queue"),
+            self._get("history", {"pageSize": 1000, "eventType": 1}),  # eventType 1 = grabbed
+            self._get("history", {"pageSize": 1000, "eventType": 3}),  # eventType 3 = imported
+        )
         if not movies:
             return metrics
         
-        # Basic counts
+        # Single pass over the library
+        since = None
+        if self.store:
+            try:
+                since = self.store.last_date("radarr")
+            except sqlite3.Error as e:
+                logger.warning(f"Error reading added counts from {self.store.path}: {e}")
         total_movies = len(movies)
-        movies_with_files = [m for m in movies if m.get("hasFile", False)]
+        movies_with_files = 0
+        total_size = 0
+        genre_counts = Counter()
+        year_counts = Counter()
+        quality_counts = Counter()
+        filetype_counts = Counter()
+        video_codec_counts = Counter()
+        audio_codec_counts = Counter()
+        added_counts = Counter()
+        
+        for movie in movies:
+            if movie.get("hasFile", False):
+                movies_with_files += 1
+                total_size += movie.get("sizeOnDisk", 0)
+                
+                movie_file = movie.get("movieFile")
+                if movie_file:
+                    # File type
+                    path = movie_file.get("relativePath")
+                    if path:
+                        filetype_counts[path.rpartition(".")[2].lower()] += 1
+                    
+                    # Codecs, normalizing video codec names
+                    media_info = movie_file.get("mediaInfo", {})
+                    video_codec = media_info.get("videoCodec", "Unknown")
+                    video_codec_counts[_CODEC_MAP.get(video_codec, video_codec)] += 1
+                    audio_codec_counts[media_info.get("audioCodec", "Unknown")] += 1
+            
+            genre_counts.update(movie.get("genres") or ())
+            
+            year = movie.get("year")
+            if year:
+                year_counts[str(year)] += 1
+            
+            profile = movie.get("qualityProfileId")
+            if profile:
+                quality_counts[f"profile_{profile}"] += 1
+            
+            added = movie.get("added")
+            if since is not None and added and added[:10] >= since:
+                added_counts[added[:10]] += 1
+        
+        # Basic counts
         metrics['radarr_movies_total'] = total_movies
-        metrics['radarr_movies_downloaded'] = len(movies_with_files)
-        metrics['radarr_movies_missing'] = total_movies - len(movies_with_files)
+        metrics['radarr_movies_downloaded'] = movies_with_files
+        metrics['radarr_movies_missing'] = total_movies - movies_with_files
         
         # Disk usage
-        total_size = sum(m.get("sizeOnDisk", 0) for m in movies_with_files)
         metrics['radarr_disk_usage_bytes'] = total_size
         
         # Average size
         if movies_with_files:
-            avg_size = total_size / len(movies_with_files)
-            metrics['radarr_avg_movie_size_bytes'] = avg_size
-        
-        # Genre breakdown
-        genre_counts = defaultdict(int)
-        for movie in movies:
-            for genre in movie.get("genres", []):
-                genre_counts[genre] += 1
-        metrics['radarr_genres'] = dict(genre_counts)
+            metrics['radarr_avg_movie_size_bytes'] = total_size / movies_with_files
         
-        # Year breakdown
-        year_counts = defaultdict(int)
-        for movie in movies:
-            year = movie.get("year")
-            if year:
-                year_counts[str(year)] += 1
-        metrics['radarr_movies_by_year'] = dict(year_counts)
-        
-        # File types and codecs
-        filetype_counts = defaultdict(int)
-        video_codec_counts = defaultdict(int)
-        audio_codec_counts = defaultdict(int)
-        
-        for movie in movies_with_files:
-            movie_file = movie.get("movieFile", {})
-            if movie_file:
-                # File type
-                path = movie_file.get("relativePath", "")
-                if path:
-                    ext = path.split(".")[-1].lower()
-                    filetype_counts[ext] += 1
-                
-                # Codecs
-                media_info = movie_file.get("mediaInfo", {})
-                video_codec = media_info.get("videoCodec", "Unknown")
-                audio_codec = media_info.get("audioCodec", "Unknown")
-                
-                # Normalize video codec names
-                codec_map = {'x265': 'HEVC', 'h265': 'HEVC', 'x264': 'H.264', 'h264': 'H.264'}
-                video_codec = codec_map.get(video_codec, video_codec)
-                
-                video_codec_counts[video_codec] += 1
-                audio_codec_counts[audio_codec] += 1
-        
-        metrics['radarr_filetypes'] = dict(filetype_counts)
-        metrics['radarr_video_codecs'] = dict(video_codec_counts)
-        metrics['radarr_audio_codecs'] = dict(audio_codec_counts)
-        
-        # Movies added over time (cumulative)
-        date_counts = defaultdict(int)
-        for movie in movies:
-            added = movie.get("added")
-            if added:
-                date_str = added.split("T")[0]
-                date_counts[date_str] += 1
+        # Genre, year, file type and codec breakdowns
+        metrics['radarr_genres'] = genre_counts
+        metrics['radarr_movies_by_year'] = year_counts
+        metrics['radarr_filetypes'] = filetype_counts
+        metrics['radarr_video_codecs'] = video_codec_counts
+        metrics['radarr_audio_codecs'] = audio_codec_counts
         
         # Provide scalar cumulative as a proper time series (no historical labels)
         metrics['radarr_cumulative_movies'] = total_movies
         
+        # Persist movies added per day, recounting only days not yet stored,
+        # and export every movie ever added, including ones since deleted
+        if since is not None:
+            try:
+                self.store.update("radarr", added_counts)
+                metrics['radarr_movies_added_total'] = self.store.total("radarr")
+            except sqlite3.Error as e:
+                logger.warning(f"Error writing added counts to {self.store.path}: {e}")
+        
         # Quality profiles
-        quality_counts = defaultdict(int)
-        for movie in movies:
-            profile = movie.get("qualityProfileId")
-            if profile:
-                quality_counts[f"profile_{profile}"] += 1
-        metrics['radarr_quality_profiles'] = dict(quality_counts)
+        metrics['radarr_quality_profiles'] = quality_counts
         
         # Queue/download info
-        queue = self._get("queue")
         if queue:
             records = queue.get("records", [])
             metrics['radarr_queue_total'] = len(records)
@@ -168,74 +340,81 @@ class RadarrCollector:
             download_times = []
             for record in records:
                 if record.get("status") == "downloading":
-                    estimated = record.get("estimatedCompletionTime")
-                    added = record.get("added")
-                    if estimated and added:
-                        try:
-                            est_time = datetime.fromisoformat(estimated.replace("Z", "+00:00"))
-                            add_time = datetime.fromisoformat(added.replace("Z", "+00:00"))
-                            duration = (est_time - add_time).total_seconds()
-                            if duration > 0:
-                                download_times.append(duration)
-                        except:
-                            pass
+                    estimated_ts = _parse_iso(record.get("estimatedCompletionTime"))
+                    added_ts = _parse_iso(record.get("added"))
+                    if estimated_ts is not None and added_ts is not None and estimated_ts > added_ts:
+                        download_times.append(estimated_ts - added_ts)
             
             if download_times:
                 metrics['radarr_avg_download_time_seconds'] = sum(download_times) / len(download_times)
         
         # History - average time from grab to import
-        history = self._get("history", {"pageSize": 100, "eventType": 1})  # eventType 1 = grabbed
-        if history and history.get("records"):
-            import_times = []
-            grabbed_events = {r["movieId"]: r["date"] for r in history["records"] if r.get("eventType") == "grabbed"}
+        if grab_history and grab_history.get("records") and import_history:
+            # Records are already filtered to grabs server-side; parse each
+            # grab date to a Unix timestamp once. A movie can be grabbed
+            # several times (upgrades, failed downloads), so match imports
+            # to their grab by downloadId, falling back to movieId
+            grabbed_at = {}
+            for record in grab_history["records"]:
+                grab_ts = _parse_iso(record.get("date"))
+                key = record.get("downloadId") or record.get("movieId")
+                if grab_ts is not None and key is not None:
+                    grabbed_at[key] = grab_ts
             
-            import_history = self._get("history", {"pageSize": 100, "eventType": 3})  # eventType 3 = imported
-            if import_history and import_history.get("records"):
-                for record in import_history["records"]:
-                    movie_id = record.get("movieId")
-                    if movie_id in grabbed_events:
-                        try:
-                            import_time = datetime.fromisoformat(record["date"].replace("Z", "+00:00"))
-                            grab_time = datetime.fromisoformat(grabbed_events[movie_id].replace("Z", "+00:00"))
-                            duration = (import_time - grab_time).total_seconds()
-                            if duration > 0 and duration < 86400 * 7:  # Less than 7 days
-                                import_times.append(duration)
-                        except:
-                            pass
+            import_times = []
+            for record in import_history.get("records", []):
+                grab_ts = grabbed_at.get(record.get("downloadId") or record.get("movieId"))
+                if grab_ts is None:
+                    continue
+                import_ts = _parse_iso(record.get("date"))
+                if import_ts is not None and 0 < import_ts - grab_ts < 86400 * 7:  # Less than 7 days
+                    import_times.append(import_ts - grab_ts)
             
             if import_times:
                 metrics['radarr_avg_import_time_seconds'] = sum(import_times) / len(import_times)
         
-        logger.info(f"Collected Radarr metrics: {total_movies} total movies, {len(movies_with_files)} downloaded")
+        logger.info(f"Collected Radarr metrics: {total_movies} total movies, {movies_with_files} downloaded")
         return metrics
 
 
 class SonarrCollector:
     """Collects metrics from Sonarr"""
     
-    def __init__(self, url: str, api_key: str):
+    def __init__(self, url: str, api_key: str, cache_ttls: Dict[str, int] = None,
+                 cache_max_stale: int = 900, store: Optional[AddedCountsStore] = None):
         self.url = url.rstrip('/')
         self.api_key = api_key
         self.headers = {"X-Api-Key": api_key}
-        self.session = requests.Session()
+        self.session: Optional[aiohttp.ClientSession] = None  # shared, set by MediaExporter
+        self.cache = TTLCache(cache_ttls, cache_max_stale)
+        self.store = store
+        # Bound concurrent requests so sampled episode fetches don't hammer Sonarr
+        self.semaphore = asyncio.Semaphore(8)
     
-    def _get(self, endpoint: str, params: Dict = None) -> Any:
-        """Make GET request to Sonarr API"""
+    async def _get(self, endpoint: str, params: Dict = None) -> Any:
+        """Make GET request to Sonarr API, serving cached responses where fresh"""
+        cached = self.cache.get(endpoint, params)
+        if cached is not None:
+            return cached
         try:
             url = f"{self.url}/api/v3/{endpoint}"
-            response = self.session.get(url, headers=self.headers, params=params, timeout=30)
-            response.raise_for_status()
-            return response.json()
+            async with self.semaphore:
+                data = await _fetch_json(self.session, "GET", url, headers=self.headers, params=params)
+            self.cache.set(endpoint, params, data)
+            return data
         except Exception as e:
             logger.error(f"Error fetching {endpoint}: {e}")
+            if _is_unavailable(e):
+                # Fall back to a recent good response while the service is down
+                return self.cache.get_stale(endpoint, params)
             return None
     
-    def collect_metrics(self) -> Dict[str, Any]:
+    async def collect_metrics(self) -> Dict[str, Any]:
         """Collect all Sonarr metrics"""
         metrics = {}
         
-        # Get all series
-        series = self._get("series")
+        # Fetch series and queue concurrently
+        series, queue = await asyncio.gather(self._get("series"), self._get("queue"))
         if not series:
             return metrics
         
@@ -243,12 +422,15 @@ class SonarrCollector:
         total_series = len(series)
         metrics['sonarr_series_total'] = total_series
         
-        # Episode and disk statistics
+        # Single pass over the library
         total_episodes = 0
         total_episode_files = 0
         total_size = 0
         series_sizes = []
         episode_counts = []
+        genre_counts = Counter()
+        status_counts = Counter()
+        added_counts = Counter()
         
         for show in series:
             stats = show.get("statistics", {})
@@ -264,6 +446,13 @@ class SonarrCollector:
                 series_sizes.append(size)
             if ep_count > 0:
                 episode_counts.append(ep_count)
+            
+            genre_counts.update(show.get("genres") or ())
+            status_counts[show.get("status", "unknown")] += 1
+            
+            added = show.get("added")
+            if self.store and added and ep_file_count > 0:
+                added_counts[added[:10]] += ep_file_count
         
         metrics['sonarr_episodes_total'] = total_episodes
         metrics['sonarr_episodes_downloaded'] = total_episode_files
@@ -276,69 +465,46 @@ class SonarrCollector:
         if episode_counts:
             metrics['sonarr_avg_episodes_per_series'] = sum(episode_counts) / len(episode_counts)
         
-        # Genre breakdown
-        genre_counts = defaultdict(int)
-        for show in series:
-            for genre in show.get("genres", []):
-                genre_counts[genre] += 1
-        metrics['sonarr_genres'] = dict(genre_counts)
-        
-        # Status breakdown
-        status_counts = defaultdict(int)
-        for show in series:
-            status = show.get("status", "unknown")
-            status_counts[status] += 1
-        metrics['sonarr_series_by_status'] = dict(status_counts)
-        
-        # Episodes added over time (cumulative)
-        date_counts = defaultdict(int)
-        for show in series:
-            added = show.get("added")
-            episode_count = show.get("statistics", {}).get("episodeFileCount", 0)
-            if added and episode_count > 0:
-                date_str = added.split("T")[0]
-                date_counts[date_str] += episode_count
+        # Genre and status breakdowns
+        metrics['sonarr_genres'] = genre_counts
+        metrics['sonarr_series_by_status'] = status_counts
         
         # Provide scalar cumulative as a proper time series (no historical labels)
         metrics['sonarr_cumulative_episodes'] = total_episodes
         
+        # Persist episode files per series added date; every day is recounted
+        # because downloads keep changing the counts of past days
+        if self.store:
+            try:
+                self.store.replace("sonarr", added_counts)
+            except sqlite3.Error as e:
+                logger.warning(f"Error writing added counts to {self.store.path}: {e}")
+        
         # Get file types from a sample of episodes (to avoid too many API calls)
         # We'll just get from the first few series
-        filetype_counts = defaultdict(int)
-        video_codec_counts = defaultdict(int)
-        audio_codec_counts = defaultdict(int)
-        
-        for show in series[:10]:  # Sample first 10 shows
-            episodes = self._get("episode", {"seriesId": show["id"]})
-            if episodes:
-                for ep in episodes[:5]:  # Sample first 5 episodes per show
-                    ep_file = ep.get("episodeFile")
-                    if ep_file:
-                        # File type
-                        path = ep_file.get("relativePath", "")
-                        if path:
-                            ext = path.split(".")[-1].lower()
-                            filetype_counts[ext] += 1
-                        
-                        # Codecs
-                        media_info = ep_file.get("mediaInfo", {})
-                        video_codec = media_info.get("videoCodec", "Unknown")
-                        audio_codec = media_info.get("audioCodec", "Unknown")
-                        
-                        # Normalize video codec
-                        codec_map = {'x265': 'HEVC', 'h265': 'HEVC', 'x264': 'H.264', 'h264': 'H.264'}
-                        video_codec = codec_map.get(video_codec, video_codec)
-                        
-                        video_codec_counts[video_codec] += 1
-                        audio_codec_counts[audio_codec] += 1
+        sampled_episodes = await asyncio.gather(*[
+            self._get("episode", {"seriesId": show["id"]}) for show in series[:10]
+        ])
+        
+        # Sample first 5 episodes per show
+        episode_files = [
+            ep["episodeFile"] for episodes in sampled_episodes if episodes
+            for ep in episodes[:5] if ep.get("episodeFile")
+        ]
+        media_infos = [f.get("mediaInfo", {}) for f in episode_files]
+        filetype_counts = Counter(
+            path.rpartition(".")[2].lower() for path in (f.get("relativePath") for f in episode_files) if path
+        )
         
         if filetype_counts:
-            metrics['sonarr_filetypes'] = dict(filetype_counts)
-            metrics['sonarr_video_codecs'] = dict(video_codec_counts)
-            metrics['sonarr_audio_codecs'] = dict(audio_codec_counts)
+            metrics['sonarr_filetypes'] = filetype_counts
+            # Normalize video codec names
+            metrics['sonarr_video_codecs'] = Counter(
+                _CODEC_MAP.get(codec, codec) for codec in (i.get("videoCodec", "Unknown") for i in media_infos)
+            )
+            metrics['sonarr_audio_codecs'] = Counter(i.get("audioCodec", "Unknown") for i in media_infos)
         
         # Queue info
-        queue = self._get("queue")
         if queue:
             records = queue.get("records", [])
             metrics['sonarr_queue_total'] = len(records)
@@ -351,24 +517,31 @@ class SonarrCollector:
 class JellyfinCollector:
     """Collects metrics from Jellyfin"""
     
-    def __init__(self, url: str, api_key: str):
+    def __init__(self, url: str, api_key: str, cache_ttls: Dict[str, int] = None, cache_max_stale: int = 900):
         self.url = url.rstrip('/')
         self.api_key = api_key
         self.headers = {"X-Emby-Token": api_key}
-        self.session = requests.Session()
+        self.session: Optional[aiohttp.ClientSession] = None  # shared, set by MediaExporter
+        self.cache = TTLCache(cache_ttls, cache_max_stale)
     
-    def _get(self, endpoint: str, params: Dict = None) -> Any:
-        """Make GET request to Jellyfin API"""
+    async def _get(self, endpoint: str, params: Dict = None) -> Any:
+        """Make GET request to Jellyfin API, serving cached responses where fresh"""
+        cached = self.cache.get(endpoint, params)
+        if cached is not None:
+            return cached
         try:
             url = f"{self.url}/{endpoint}"
-            response = self.session.get(url, headers=self.headers, params=params, timeout=30)
-            response.raise_for_status()
-            return response.json()
+            data = await _fetch_json(self.session, "GET", url, headers=self.headers, params=params)
+            self.cache.set(endpoint, params, data)
+            return data
         except Exception as e:
             logger.error(f"Error fetching {endpoint}: {e}")
+            if _is_unavailable(e):
+                # Fall back to a recent good response while the service is down
+                return self.cache.get_stale(endpoint, params)
             return None
     
-    def _post(self, endpoint: str, data: Dict = None) -> Any:
+    async def _post(self, endpoint: str, data: Dict = None) -> Any:
         """Make POST request to Jellyfin API"""
         try:
             url = f"{self.url}/{endpoint}"
@@ -376,34 +549,60 @@ class JellyfinCollector:
                 **self.headers,
                 "Content-Type": "application/json"
             }
-            response = self.session.post(url, headers=headers, json=data, timeout=30)
-            response.raise_for_status()
-            return response.json()
+            return await _fetch_json(self.session, "POST", url, headers=headers, json=data)
         except Exception as e:
             logger.error(f"Error posting to {endpoint}: {e}")
             return None
     
-    def collect_metrics(self) -> Dict[str, Any]:
+    async def _get_playback_activity(self) -> Any:
+        """Fetch the last 30 days of playback activity (requires user_usage_stats plugin)"""
+        try:
+            query_data = {
+                "CustomQueryString": """
+                    SELECT ROWID, * FROM PlaybackActivity 
+                    WHERE DateCreated >= datetime('now', '-30 days') 
+                    ORDER BY DateCreated DESC
+                """,
+                "ReplaceUserId": True
+            }
+            headers_custom = {
+                "Accept": "application/json",
+                "Authorization": f"MediaBrowser Token={self.api_key}",
+                "Content-Type": "application/json"
+            }
+            return await _fetch_json(
+                self.session, "POST", f"{self.url}/user_usage_stats/submit_custom_query",
+                timeout=15, raise_for_status=False, json=query_data, headers=headers_custom
+            )
+        except Exception as e:
+            logger.warning(f"Could not fetch playback stats (user_usage_stats plugin may not be installed): {e}")
+            return None
+    
+    async def collect_metrics(self) -> Dict[str, Any]:
         """Collect all Jellyfin metrics"""
         metrics = {}
         
-        # Get active sessions
-        sessions = self._get("Sessions")
+        # Fetch sessions, users and 30-day statistics concurrently
+        sessions, users, playback, activity = await asyncio.gather(
+            self._get("Sessions"),
+            self._get("Users"),
+            self._get_playback_activity(),
+            self._get("user_usage_stats/user_activity", {"days": 30, "timezoneOffset": 0}),
+        )
+        
+        # Active sessions
         if sessions:
             active_streams = [s for s in sessions if s.get("NowPlayingItem")]
             metrics['jellyfin_active_streams'] = len(active_streams)
             
             # Breakdown by media type
-            stream_types = defaultdict(int)
-            for session in active_streams:
-                media_type = session.get("NowPlayingItem", {}).get("Type", "Unknown")
-                stream_types[media_type] += 1
-            metrics['jellyfin_streams_by_type'] = dict(stream_types)
+            metrics['jellyfin_streams_by_type'] = Counter(
+                session["NowPlayingItem"].get("Type", "Unknown") for session in active_streams
+            )
         else:
             metrics['jellyfin_active_streams'] = 0
         
-        # Get users
-        users = self._get("Users")
+        # Users
         if users:
             metrics['jellyfin_users_total'] = len(users)
             user_ids = [u["Id"] for u in users]
@@ -412,63 +611,44 @@ class JellyfinCollector:
         
         # Playback statistics (requires user_usage_stats plugin)
         try:
-            query_data = {
-                "CustomQueryString": """
-                    SELECT ROWID, * FROM PlaybackActivity 
-                    WHERE DateCreated >= datetime('now', '-30 days') 
-                    ORDER BY DateCreated DESC
-                """,
-                "ReplaceUserId": True
-            }
-            headers_custom = {
-                "Accept": "application/json",
-                "Authorization": f"MediaBrowser Token={self.api_key}",
-                "Content-Type": "application/json"
-            }
-            response = self.session.post(
-                f"{self.url}/user_usage_stats/submit_custom_query",
-                json=query_data,
-                headers=headers_custom,
-                timeout=15
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                results = data.get("results", [])
-                columns = data.get("colums", [])  # Note: API typo
+            if playback:
+                results = playback.get("results", [])
+                columns = playback.get("colums", [])  # Note: API typo
+                
+                # Resolve column positions once rather than zipping every row into a dict
+                method_idx = columns.index("PlaybackMethod") if "PlaybackMethod" in columns else None
+                date_idx = columns.index("DateCreated") if "DateCreated" in columns else None
                 
                 # Count playback methods
-                playback_methods = defaultdict(int)
-                for row in results:
-                    playback_data = dict(zip(columns, row))
-                    method = playback_data.get("PlaybackMethod", "Unknown")
-                    playback_methods[method] += 1
+                if method_idx is not None:
+                    playback_methods = Counter(row[method_idx] for row in results)
+                else:
+                    playback_methods = Counter({"Unknown": len(results)}) if results else Counter()
                 
-                metrics['jellyfin_playback_methods'] = dict(playback_methods)
+                metrics['jellyfin_playback_methods'] = playback_methods
                 metrics['jellyfin_playback_count_30d'] = len(results)
                 
                 # Heatmap data - playback by hour
-                hour_counts = defaultdict(int)
-                for row in results:
-                    playback_data = dict(zip(columns, row))
-                    date_created = playback_data.get("DateCreated")
-                    if date_created:
-                        try:
-                            dt = datetime.strptime(date_created[:13], "%Y-%m-%d %H")
-                            hour_counts[dt.hour] += 1
-                        except:
-                            pass
+                hour_counts = Counter()
+                if date_idx is not None:
+                    for row in results:
+                        # DateCreated is "YYYY-MM-DD HH:MM:SS..."; read the hour digits directly
+                        date_created = row[date_idx]
+                        if not isinstance(date_created, str) or len(date_created) < 13:
+                            continue
+                        hour = date_created[11:13]
+                        if hour.isdigit() and int(hour) < 24:
+                            hour_counts[int(hour)] += 1
                 
-                metrics['jellyfin_playback_by_hour'] = dict(hour_counts)
+                metrics['jellyfin_playback_by_hour'] = hour_counts
         except Exception as e:
             logger.warning(f"Could not fetch playback stats (user_usage_stats plugin may not be installed): {e}")
         
         # User activity (30 days)
         try:
-            response = self._get("user_usage_stats/user_activity", {"days": 30, "timezoneOffset": 0})
-            if response:
+            if activity:
                 user_activity = {}
-                for user in response:
+                for user in activity:
                     username = user.get("user_name", "Unknown")
                     play_count = user.get("total_count", 0)
                     user_activity[username] = play_count
@@ -476,38 +656,33 @@ class JellyfinCollector:
         except Exception as e:
             logger.warning(f"Could not fetch user activity: {e}")
         
-        # Popular movies (30 days)
+        # Popular movies and shows (30 days). The Playback Reporting reports
+        # cover the whole library and ignore UserId, so one request each is
+        # enough; summing per-user responses would multiply every play count.
         if user_ids:
+            report_params = {"days": 30, "UserId": user_ids[0], "timezoneOffset": 0}
+            movies, shows = await asyncio.gather(
+                self._get("user_usage_stats/MoviesReport", report_params),
+                self._get("user_usage_stats/GetTvShowsReport", report_params),
+            )
+            
             try:
-                for user_id in user_ids[:1]:  # Just use first user for popular content
-                    movies = self._get("user_usage_stats/MoviesReport", {
-                        "days": 30,
-                        "UserId": user_id,
-                        "timezoneOffset": 0
-                    })
-                    if movies:
-                        # Top 10 movies
-                        top_movies = sorted(movies, key=lambda x: x.get("count", 0), reverse=True)[:10]
-                        movie_counts = {m.get("label", "Unknown"): m.get("count", 0) for m in top_movies}
-                        metrics['jellyfin_top_movies'] = movie_counts
-                        break
+                if movies:
+                    # Top 10 movies
+                    movie_counts = Counter()
+                    for m in movies:
+                        movie_counts[m.get("label", "Unknown")] += m.get("count", 0)
+                    metrics['jellyfin_top_movies'] = dict(movie_counts.most_common(10))
             except Exception as e:
                 logger.warning(f"Could not fetch popular movies: {e}")
             
-            # Popular shows (30 days)
             try:
-                for user_id in user_ids[:1]:
-                    shows = self._get("user_usage_stats/GetTvShowsReport", {
-                        "days": 30,
-                        "UserId": user_id,
-                        "timezoneOffset": 0
-                    })
-                    if shows:
-                        # Top 10 shows
-                        top_shows = sorted(shows, key=lambda x: x.get("count", 0), reverse=True)[:10]
-                        show_counts = {s.get("label", "Unknown"): s.get("count", 0) for s in top_shows}
-                        metrics['jellyfin_top_shows'] = show_counts
-                        break
+                if shows:
+                    # Top 10 shows
+                    show_counts = Counter()
+                    for s in shows:
+                        show_counts[s.get("label", "Unknown")] += s.get("count", 0)
+                    metrics['jellyfin_top_shows'] = dict(show_counts.most_common(10))
             except Exception as e:
                 logger.warning(f"Could not fetch popular shows: {e}")
         
@@ -515,8 +690,79 @@ class JellyfinCollector:
         return metrics
 
 
+class ArrCollector:
+    """Prometheus collector serving metric families from the last collection
+    
+    Families are rebuilt from scratch for each collection, so labels that
+    disappear upstream (removed genres, codecs, ...) are dropped instead of
+    lingering with their last value.
+    """
+    
+    def __init__(self):
+        self._families: Dict[str, List[GaugeMetricFamily]] = {}
+        self._builders: Dict[Tuple, Callable[[Dict[str, Any]], List[GaugeMetricFamily]]] = {}
+    
+    @staticmethod
+    def compile_builder(metrics: Dict[str, Any], prefix: str) -> Callable[[Dict[str, Any]], List[GaugeMetricFamily]]:
+        """Generate a family builder specialized to the shape of a metrics dict
+        
+        Metric names, descriptions and scalar/labeled dispatch are resolved
+        once here and hard-coded into the generated function, so building
+        families for later collections with the same keys does no type checks
+        or name formatting. Labeled metrics are dicts of numeric values.
+        """
+        lines = ["def build(metrics):", "    families = []"]
+        for key, value in metrics.items():
+            metric_name = f"{prefix}_{key}" if not key.startswith(prefix) else key
+            
+            if isinstance(value, (int, float)):
+                # Simple numeric metric
+                lines.append(
+                    f"    families.append(GaugeMetricFamily({metric_name!r}, {metric_name + ' value'!r}, "
+                    f"value=metrics[{key!r}]))"
+                )
+            
+            elif isinstance(value, dict):
+                # Labeled metric, skipped while empty
+                lines += [
+                    f"    value = metrics[{key!r}]",
+                    "    if value:",
+                    f"        family = GaugeMetricFamily({metric_name!r}, {metric_name + ' breakdown'!r}, labels=['label'])",
+                    "        for label, val in value.items():",
+                    "            family.add_metric([str(label)], val)",
+                    "        families.append(family)",
+                ]
+        lines.append("    return families")
+        
+        namespace = {"GaugeMetricFamily": GaugeMetricFamily}
+        exec(compile("\n".join(lines), f"<{prefix} metric families>", "exec"), namespace)
+        return namespace["build"]
+    
+    def build_families(self, metrics: Dict[str, Any], prefix: str) -> List[GaugeMetricFamily]:
+        """Build gauge families from a collector's metrics dict"""
+        shape = (prefix, tuple(metrics))
+        builder = self._builders.get(shape)
+        if builder is None:
+            builder = self._builders[shape] = self.compile_builder(metrics, prefix)
+        return builder(metrics)
+    
+    def update(self, prefix: str, metrics: Dict[str, Any]):
+        """Replace the families for one source with a single reference swap"""
+        self._families = {**self._families, prefix: self.build_families(metrics, prefix)}
+    
+    def collect(self):
+        """Yield the families from the last collection of each source"""
+        for families in self._families.values():
+            yield from families
+
+
 class MediaExporter:
-    """Main Prometheus exporter class"""
+    """Main Prometheus exporter class
+    
+    Metrics are collected in a background thread every SCRAPE_INTERVAL and
+    served by an ArrCollector, so Prometheus scrapes of /metrics never
+    trigger upstream requests regardless of the scrape interval.
+    """
     
     def __init__(self, config: Config):
         self.config = config
@@ -524,100 +770,94 @@ class MediaExporter:
         self.sonarr = None
         self.jellyfin = None
         
+        store = None
+        if config.STATE_DB:
+            try:
+                store = AddedCountsStore(config.STATE_DB)
+                logger.info(f"Persisting added counts to {config.STATE_DB}")
+            except sqlite3.Error as e:
+                logger.error(f"Cannot open STATE_DB {config.STATE_DB}, added counts will not be persisted: {e}")
+        
         # Initialize collectors
         if config.RADARR_URL and config.RADARR_API_KEY:
-            self.radarr = RadarrCollector(config.RADARR_URL, config.RADARR_API_KEY, config.TMDB_API_KEY)
+            self.radarr = RadarrCollector(
+                config.RADARR_URL, config.RADARR_API_KEY, config.TMDB_API_KEY,
+                config.CACHE_TTLS, config.CACHE_MAX_STALE, store
+            )
             logger.info("Radarr collector initialized")
         
         if config.SONARR_URL and config.SONARR_API_KEY:
-            self.sonarr = SonarrCollector(config.SONARR_URL, config.SONARR_API_KEY)
+            self.sonarr = SonarrCollector(
+                config.SONARR_URL, config.SONARR_API_KEY, config.CACHE_TTLS, config.CACHE_MAX_STALE, store
+            )
             logger.info("Sonarr collector initialized")
         
         if config.JELLYFIN_URL and config.JELLYFIN_API_KEY:
-            self.jellyfin = JellyfinCollector(config.JELLYFIN_URL, config.JELLYFIN_API_KEY)
+            self.jellyfin = JellyfinCollector(
+                config.JELLYFIN_URL, config.JELLYFIN_API_KEY, config.CACHE_TTLS, config.CACHE_MAX_STALE
+            )
             logger.info("Jellyfin collector initialized")
         
         # Prometheus metrics
-        self.gauges = {}
+        self.collector = ArrCollector()
     
-    def _get_or_create_gauge(self, name: str, description: str, labels: List[str] = None) -> Gauge:
-        """Get or create a Prometheus Gauge"""
-        if name not in self.gauges:
-            self.gauges[name] = Gauge(name, description, labels or [])
-        return self.gauges[name]
+    async def _collect_source(self, name: str, collector: Any, prefix: str):
+        """Collect metrics from a single source and export them"""
+        try:
+            metrics = await collector.collect_metrics()
+            self.collector.update(prefix, metrics)
+        except Exception as e:
+            logger.error(f"Error collecting {name} metrics: {e}")
     
-    def export_metrics(self, metrics: Dict[str, Any], prefix: str):
-        """Export metrics to Prometheus"""
-        for key, value in metrics.items():
-            metric_name = f"{prefix}_{key}" if not key.startswith(prefix) else key
-            
-            if isinstance(value, (int, float)):
-                # Simple numeric metric
-                gauge = self._get_or_create_gauge(metric_name, f"{metric_name} value")
-                gauge.set(value)
-            
-            elif isinstance(value, dict):
-                # Labeled metric
-                if not value:
-                    continue
-                    
-                # Determine if values are numeric or need special handling
-                sample_value = next(iter(value.values()))
-                
-                if isinstance(sample_value, (int, float)):
-                    # Create labeled gauge
-                    gauge = self._get_or_create_gauge(
-                        metric_name,
-                        f"{metric_name} breakdown",
-                        ['label']
-                    )
-                    for label, val in value.items():
-                        gauge.labels(label=str(label)).set(val)
-    
-    def collect_and_export(self):
-        """Collect metrics from all sources and export"""
+    async def collect_and_export(self):
+        """Collect metrics from all sources concurrently and export"""
         logger.info("Starting metric collection...")
         
-        # Collect from Radarr
-        if self.radarr:
-            try:
-                radarr_metrics = self.radarr.collect_metrics()
-                self.export_metrics(radarr_metrics, 'radarr')
-            except Exception as e:
-                logger.error(f"Error collecting Radarr metrics: {e}")
-        
-        # Collect from Sonarr
-        if self.sonarr:
-            try:
-                sonarr_metrics = self.sonarr.collect_metrics()
-                self.export_metrics(sonarr_metrics, 'sonarr')
-            except Exception as e:
-                logger.error(f"Error collecting Sonarr metrics: {e}")
-        
-        # Collect from Jellyfin
-        if self.jellyfin:
-            try:
-                jellyfin_metrics = self.jellyfin.collect_metrics()
-                self.export_metrics(jellyfin_metrics, 'jellyfin')
-            except Exception as e:
-                logger.error(f"Error collecting Jellyfin metrics: {e}")
+        sources = [
+            ("Radarr", self.radarr, 'radarr'),
+            ("Sonarr", self.sonarr, 'sonarr'),
+            ("Jellyfin", self.jellyfin, 'jellyfin'),
+        ]
+        await asyncio.gather(*[
+            self._collect_source(name, collector, prefix)
+            for name, collector, prefix in sources
+            if collector
+        ])
         
         logger.info("Metric collection completed")
     
+    async def _collect_loop(self):
+        """Collect metrics every SCRAPE_INTERVAL over one shared HTTP session"""
+        async with _new_session() as session:
+            for collector in (self.radarr, self.sonarr, self.jellyfin):
+                if collector:
+                    collector.session = session
+            
+            while True:
+                try:
+                    await self.collect_and_export()
+                except Exception as e:
+                    logger.error(f"Error in collection loop: {e}")
+                
+                await asyncio.sleep(self.config.SCRAPE_INTERVAL)
+    
+    def _refresh_loop(self):
+        """Background thread entry point: run the collection loop"""
+        asyncio.run(self._collect_loop())
+    
     def run(self):
         """Run the exporter"""
+        REGISTRY.register(self.collector)
+        
+        # Collect metrics periodically in the background
+        refresh_thread = threading.Thread(target=self._refresh_loop, name="refresh", daemon=True)
+        refresh_thread.start()
+        
         # Start Prometheus HTTP server
         start_http_server(self.config.EXPORTER_PORT)
         logger.info(f"Prometheus exporter started on port {self.config.EXPORTER_PORT}")
         
-        # Collect metrics periodically
-        while True:
-            try:
-                self.collect_and_export()
-            except Exception as e:
-                logger.error(f"Error in collection loop: {e}")
-            
-            time.sleep(self.config.SCRAPE_INTERVAL)
+        refresh_thread.join()
 
 
 def main():
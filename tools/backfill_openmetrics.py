@@ -1,10 +1,16 @@
 import os
 import sys
-import time
-from collections import defaultdict
-from datetime import datetime
+from collections import Counter
+from itertools import accumulate
+from datetime import datetime, timezone
+from functools import lru_cache
+import orjson
 import requests
 
+# Share the exporter's state DB code; it lives next to exporter.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from added_counts import AddedCountsStore
+
 
 def iso_date(dt_str: str) -> str:
     return dt_str.split("T")[0]
@@ -13,60 +19,74 @@ def iso_date(dt_str: str) -> str:
 def fetch_radarr_movies(url: str, api_key: str):
     r = requests.get(f"{url}/api/v3/movie", headers={"X-Api-Key": api_key}, timeout=30)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
 def fetch_sonarr_series(url: str, api_key: str):
     r = requests.get(f"{url}/api/v3/series", headers={"X-Api-Key": api_key}, timeout=30)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
-def build_cumulative_by_date_radarr(movies):
-    date_counts = defaultdict(int)
-    for m in movies:
-        added = m.get("added")
-        if added:
-            date_counts[iso_date(added)] += 1
-    total = 0
-    out = []  # list of (date_str, value)
-    for d in sorted(date_counts.keys()):
-        total += date_counts[d]
-        out.append((d, total))
-    return out
+def cumulative_by_date(date_counts):
+    # list of (date_str, running total), summed in C by itertools.accumulate
+    dates = sorted(date_counts)
+    return list(zip(dates, accumulate(date_counts[d] for d in dates)))
 
 
-def build_cumulative_by_date_sonarr(series):
-    date_counts = defaultdict(int)
+def count_added_by_date_radarr(movies):
+    return Counter(iso_date(m["added"]) for m in movies if m.get("added"))
+
+
+def count_added_by_date_sonarr(series):
+    date_counts = Counter()
     for s in series:
         added = s.get("added")
         ep_files = s.get("statistics", {}).get("episodeFileCount", 0)
         if added and ep_files > 0:
             date_counts[iso_date(added)] += ep_files
-    total = 0
-    out = []
-    for d in sorted(date_counts.keys()):
-        total += date_counts[d]
-        out.append((d, total))
-    return out
+    return date_counts
+
+
+def build_cumulative_by_date_radarr(movies):
+    return cumulative_by_date(count_added_by_date_radarr(movies))
 
 
+def build_cumulative_by_date_sonarr(series):
+    return cumulative_by_date(count_added_by_date_sonarr(series))
+
+
+def cumulative_from_state_db(store, source, date_counts, replace=False):
+    # Merge freshly fetched counts into the exporter's state DB with the
+    # exporter's own rules, then let SQLite compute the running total over
+    # everything it has stored. Past Radarr days are never rewritten, so
+    # movies deleted since keep counting; Sonarr days are all replaced.
+    if replace:
+        store.replace(source, date_counts)
+    else:
+        store.update_since_last(source, date_counts)
+    return store.cumulative(source)
+
+
+@lru_cache(maxsize=None)
 def to_unix_ms(date_str: str) -> int:
     # Interpret date as UTC midnight
-    dt = datetime.strptime(date_str, "%Y-%m-%d")
-    return int(time.mktime(dt.timetuple()) * 1000)
+    dt = datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
 
 
 def write_openmetrics(radarr_series, sonarr_series, fp):
-    fp.write("# TYPE radarr_cumulative_movies gauge\n")
-    for d, v in radarr_series:
-        fp.write(f"radarr_cumulative_movies {v} {to_unix_ms(d)}\n")
-    fp.write("\n")
+    # Build the whole document in memory and write it once
+    lines = ["# TYPE radarr_cumulative_movies gauge"]
+    lines.extend(f"radarr_cumulative_movies {v} {to_unix_ms(d)}" for d, v in radarr_series)
+    lines.append("")
+
+    lines.append("# TYPE sonarr_cumulative_episodes gauge")
+    lines.extend(f"sonarr_cumulative_episodes {v} {to_unix_ms(d)}" for d, v in sonarr_series)
+    lines.append("")
+    lines.append("# EOF")
 
-    fp.write("# TYPE sonarr_cumulative_episodes gauge\n")
-    for d, v in sonarr_series:
-        fp.write(f"sonarr_cumulative_episodes {v} {to_unix_ms(d)}\n")
-    fp.write("\n# EOF\n")
+    fp.write("\n".join(lines) + "\n")
 
 
 def main():
@@ -79,13 +99,26 @@ def main():
         print("Missing RADARR_URL or RADARR_API_KEY", file=sys.stderr)
         sys.exit(2)
 
+    # Optional: share per-day counts with the exporter's STATE_DB
+    state_db = os.getenv("STATE_DB")
+    store = AddedCountsStore(state_db) if state_db else None
+
     movies = fetch_radarr_movies(radarr_url.rstrip("/"), radarr_api)
-    radarr_series = build_cumulative_by_date_radarr(movies)
+    if store:
+        radarr_series = cumulative_from_state_db(store, "radarr", count_added_by_date_radarr(movies))
+    else:
+        radarr_series = build_cumulative_by_date_radarr(movies)
 
     sonarr_series = []
     if sonarr_url and sonarr_api:
         series = fetch_sonarr_series(sonarr_url.rstrip("/"), sonarr_api)
-        sonarr_series = build_cumulative_by_date_sonarr(series)
+        if store:
+            sonarr_series = cumulative_from_state_db(store, "sonarr", count_added_by_date_sonarr(series), replace=True)
+        else:
+            sonarr_series = build_cumulative_by_date_sonarr(series)
+
+    if store:
+        store.close()
 
     out_path = os.getenv("BACKFILL_OUT", "backfill.om")
     with open(out_path, "w", encoding="utf-8") as fp: